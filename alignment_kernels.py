@@ -0,0 +1,163 @@
+import numpy as np
+from numba import njit
+
+# Traceback states
+M, X, Y = 0, 1, 2   # aligned, gap in query (target consumed), gap in target (query consumed)
+NEG = -1e300        # finite "minus infinity" to keep sums well defined
+
+def encode(seq: str) -> np.ndarray:
+    """Return the (ASCII) sequence as a uint8 array"""
+    return np.frombuffer(seq.encode("ascii"), dtype=np.uint8)
+
+@njit(cache=True, nogil=True)
+def global_align(t, q, match_score, mismatch_score, open_gap_score, extend_gap_score, band=-1):
+    """Optimal global alignment (Gotoh) of the encoded sequences 't' and 'q'.
+
+    Gaps of length k score 'open_gap_score + (k - 1) * extend_gap_score'.
+    If 'band' is not negative, only cells within 'band' diagonals of the main
+    diagonal are considered, widened if needed so that the end cell is
+    strictly inside the band.
+
+    Returns the score, a single optimal alignment in BioPython's 'aligned'
+    representation, an array of shape (2, blocks, 2), and whether the
+    alignment touches the band's edge (in which case a better alignment
+    outside the band may exist).
+    """
+    n, m = len(t), len(q)
+    if band < 0:
+        band = max(n, m)
+    band = max(band, abs(n - m) + 1)
+    # traceback states, kept in band relative columns (j - i + band) when
+    # banded so memory grows with the band rather than with 'q'
+    banded = band < max(n, m)
+    tb = np.zeros((3, n + 1, 2 * band + 1 if banded else m + 1), dtype=np.uint8)
+
+    # precompute a per-call substitution profile: the score of each distinct
+    # character of 't' against every position of 'q', so that the inner loop
+    # doesn't need to compare characters
+    row_of = np.full(256, -1, dtype=np.int64)
+    rows = 0
+    for c in t:
+        if row_of[c] < 0:
+            row_of[c] = rows
+            rows += 1
+    profile = np.empty((rows, m))
+    for c in range(256):
+        r = row_of[c]
+        if r >= 0:
+            for j in range(m):
+                profile[r, j] = match_score if q[j] == c else mismatch_score
+
+    # score rows i-1 (p*) and i (c*) for the three states
+    pM = np.full(m + 1, NEG)
+    pX = np.full(m + 1, NEG)
+    pY = np.full(m + 1, NEG)
+    cM = np.full(m + 1, NEG)
+    cX = np.full(m + 1, NEG)
+    cY = np.full(m + 1, NEG)
+    pM[0] = 0.0
+    d = band if banded else 0
+    for j in range(1, min(m, band) + 1):
+        pY[j] = open_gap_score + (j - 1) * extend_gap_score
+        tb[Y, 0, j + d] = M if j == 1 else Y
+
+    for i in range(1, n + 1):
+        # column of cell (i, 0) in 'tb'
+        d = band - i if banded else 0
+        cM[0] = NEG
+        cY[0] = NEG
+        if i <= band:
+            cX[0] = open_gap_score + (i - 1) * extend_gap_score
+            tb[X, i, d] = M if i == 1 else X
+        else:
+            cX[0] = NEG
+        lo = max(1, i - band)
+        hi = min(m, i + band)
+        if lo > 1:
+            # left of the band (still holds row i-2)
+            cM[lo - 1] = NEG
+            cX[lo - 1] = NEG
+            cY[lo - 1] = NEG
+        scores = profile[row_of[t[i - 1]]]
+        for j in range(lo, hi + 1):
+            # M: t[i-1] aligned to q[j-1]
+            s, st = pM[j - 1], M
+            if pX[j - 1] > s:
+                s, st = pX[j - 1], X
+            if pY[j - 1] > s:
+                s, st = pY[j - 1], Y
+            cM[j] = s + scores[j - 1]
+            tb[M, i, j + d] = st
+            # X: t[i-1] aligned to a gap
+            s, st = pM[j] + open_gap_score, M
+            if pX[j] + extend_gap_score > s:
+                s, st = pX[j] + extend_gap_score, X
+            if pY[j] + open_gap_score > s:
+                s, st = pY[j] + open_gap_score, Y
+            cX[j] = s
+            tb[X, i, j + d] = st
+            # Y: q[j-1] aligned to a gap
+            s, st = cM[j - 1] + open_gap_score, M
+            if cY[j - 1] + extend_gap_score > s:
+                s, st = cY[j - 1] + extend_gap_score, Y
+            if cX[j - 1] + open_gap_score > s:
+                s, st = cX[j - 1] + open_gap_score, X
+            cY[j] = s
+            tb[Y, i, j + d] = st
+        if hi < m:
+            # right of the band, read when calculating row i+1
+            cM[hi + 1] = NEG
+            cX[hi + 1] = NEG
+            cY[hi + 1] = NEG
+        pM, cM = cM, pM
+        pX, cX = cX, pX
+        pY, cY = cY, pY
+
+    score, state = pM[m], M
+    if pX[m] > score:
+        score, state = pX[m], X
+    if pY[m] > score:
+        score, state = pY[m], Y
+
+    # trace back, collecting aligned blocks in reverse order
+    blocks = np.empty((n + m + 1, 4), dtype=np.int64)
+    nb = 0
+    in_block = False
+    on_edge = False
+    i, j = n, m
+    while i > 0 or j > 0:
+        if abs(i - j) >= band and banded:
+            on_edge = True
+        prev = tb[state, i, j + (band - i if banded else 0)]
+        if state == M:
+            if not in_block:
+                blocks[nb, 1] = i
+                blocks[nb, 3] = j
+                in_block = True
+            i -= 1
+            j -= 1
+            blocks[nb, 0] = i
+            blocks[nb, 2] = j
+            if prev != M:
+                nb += 1
+                in_block = False
+        elif state == X:
+            i -= 1
+        else:
+            j -= 1
+        state = prev
+    if in_block:
+        nb += 1
+
+    aligned = np.empty((2, nb, 2), dtype=np.int64)
+    for k in range(nb):
+        b = blocks[nb - 1 - k]
+        aligned[0, k, 0] = b[0]
+        aligned[0, k, 1] = b[1]
+        aligned[1, k, 0] = b[2]
+        aligned[1, k, 1] = b[3]
+    return score, aligned, on_edge
+
+# compile (or load from cache) now rather than on the first request, passing every
+# argument so the signature matches kernel_work's calls
+global_align(encode("GAACT"), encode("GAT"), 1.0, 0.0, -1.0, -1.0, -1)
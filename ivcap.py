@@ -1,6 +1,6 @@
 
 from utils import IVCAPRestService, IVCAPService
-from service import title, description, Request, Response
+from schema import title, description, Request, Response
 
 Service = IVCAPService(
     name=title,
@@ -0,0 +1,66 @@
+from typing import ClassVar, List, Optional
+from pydantic import Field, PrivateAttr, model_validator
+import numpy as np
+
+from utils import SchemaModel, StrEnum
+
+# Service description and the shape of its requests and responses. Kept
+# separate from service.py so it can be imported (e.g. by ivcap.py) without
+# pulling in fastapi and the alignment libraries.
+
+title = "Pairwise sequence alignment"
+summary = "Aligs two sequences to each other by optimizing the similarity score between them."
+description = """
+Pairwise sequence alignment
+
+Pairwise sequence alignment is the process of aligning two sequences to each other by optimizing the similarity
+score between them. This service supports for global and local alignments
+using the Needleman-Wunsch, Smith-Waterman, Gotoh (three-state), and Waterman-Smith-Beyer global and local
+pairwise alignment algorithms, with numerous options to change the alignment parameters.
+We refer to Durbin et al. [Durbin1998] for in-depth information on sequence alignment algorithms.
+
+The scoring follows the "pairwise sequence alignment' implementation found in the
+[BioPython](https://biopython.org/) package. Local and global alignments of DNA (ACGT) sequences with integer
+scores, fogsaa alignments, and global alignments with a 'band' are calculated by faster implementations which
+only return a single optimal alignment.
+"""
+
+MAX_ALIGNMENTS = 50
+
+class ModeE(StrEnum):
+    Global = "global"
+    Local = "local"
+    Fogsaa = "fogsaa"
+
+class Request(SchemaModel):
+    SCHEMA: ClassVar[str] = "urn:sd.test:schema.fastapi-test.request.1"
+    target: str = Field(min_length=1, description="The target sequence as a string", examples=["GAACT"])
+    query: str = Field(min_length=1, description="The sequence to align as a string", examples=["GAT"])
+    mode: ModeE = Field(ModeE.Local, description="Some decription on what a 'mode' means")
+    match_score: float = Field(1.000000, description="Some decription on what a 'match_score' means")
+    mismatch_score: float = Field(0.000000, description="Some decription on what a 'mismatch_score' means")
+    max_alignments: int = Field(MAX_ALIGNMENTS, ge=1, description="Maximum number of (equally optimal) alignments to return. " +
+                                "Local and global alignments of DNA (ACGT) sequences with integer scores, fogsaa alignments, " +
+                                "and global alignments with a 'band' only return a single optimal alignment")
+    return_alignments: bool = Field(True, description="If false, only calculate the score (faster)")
+    band: Optional[int] = Field(None, ge=0, description="Only consider this many diagonals around the main diagonal for global alignments. " +
+                                "Faster, but may miss the optimal alignment of dissimilar sequences. If not set, a band is only used " +
+                                "when the result can be verified to be optimal")
+
+    # ASCII encoded sequences, None if a sequence isn't ASCII
+    _target_enc: Optional[np.ndarray] = PrivateAttr(None)
+    _query_enc: Optional[np.ndarray] = PrivateAttr(None)
+
+    @model_validator(mode='after')
+    def encode_sequences(self) -> "Request":
+        if self.target.isascii() and self.query.isascii():
+            self._target_enc = np.frombuffer(self.target.encode("ascii"), dtype=np.uint8)
+            self._query_enc = np.frombuffer(self.query.encode("ascii"), dtype=np.uint8)
+        return self
+
+class Response(SchemaModel):
+    SCHEMA: ClassVar[str] = "urn:sd.test:schema.fastapi-test.response.1"
+    target: str = Field(description="The target sequence as a string", examples=["GAACT"])
+    query: str = Field(description="The sequence to align as a string", examples=["GAT"])
+    alignments: List[List[List[List[int]]]] = Field(description="a list of alignments")
+    score: float = Field(description="Overall score of the alignemnt?")
@@ -1,35 +1,47 @@
-from time import sleep
-from typing import ClassVar, List
-from fastapi import FastAPI
-from pydantic import Field
+import asyncio
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, List, Optional, Set, Tuple
+from fastapi import FastAPI, HTTPException
 import argparse
+from functools import lru_cache, partial
+from itertools import islice
 from signal import signal, SIGTERM
 import sys
 import os
-import random
-import string
+import secrets
+from base64 import urlsafe_b64encode
+from collections import deque
 
+from cachetools import TTLCache
 from Bio import Align
 
-from utils import SchemaModel, StrEnum
+try:
+    # Striped (SIMD) Smith-Waterman/Needleman-Wunsch - optional, BioPython is used if not installed
+    import parasail
+except ImportError:
+    parasail = None
 
-# shutdown pod cracefully
-signal(SIGTERM, lambda _1, _2: sys.exit(0))
+try:
+    # JIT compiled (numba) kernels - optional, BioPython is used if not installed
+    import alignment_kernels
+except ImportError:
+    alignment_kernels = None
 
-title = "Pairwise sequence alignment"
-summary = "Aligs two sequences to each other by optimizing the similarity score between them."
-description = """
-Pairwise sequence alignment
+from schema import title, summary, description, ModeE, Request, Response
 
-Pairwise sequence alignment is the process of aligning two sequences to each other by optimizing the similarity
-score between them. This service supports for global and local alignments
-using the Needleman-Wunsch, Smith-Waterman, Gotoh (three-state), and Waterman-Smith-Beyer global and local
-pairwise alignment algorithms, with numerous options to change the alignment parameters.
-We refer to Durbin et al. [Durbin1998] for in-depth information on sequence alignment algorithms.
-
-This service is essentially a thin wrapper over the "pairwise sequence alignment' implementation
-found in the [BioPython](https://biopython.org/) package.
-"""
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Created on every start, rather than on import, so that the app can be
+    # started more than once (e.g. in tests) and the job events belong to the
+    # running event loop. All alignments run in the pool. parasail and the
+    # numba kernels release the GIL, so this scales with the number of cores.
+    app.state.executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+    app.state.pending = PendingJobs(app.state.executor, MAX_RUNNING_JOBS)
+    app.state.job_done = {}   # jobID -> asyncio.Event, set when result is available
+    yield
+    app.state.pending.cancel()
+    app.state.executor.shutdown(wait=False, cancel_futures=True)
 
 app = FastAPI(
     title=title,
@@ -45,54 +57,233 @@ app = FastAPI(
         "url": "https://github.com/biopython/biopython/blob/master/LICENSE.rst",
     },
     docs_url="/docs", # ONLY set when there is no default GET
+    lifespan=lifespan,
+    # NOTE: Don't set a 'default_response_class' (e.g. ORJSONResponse). Without one, fastapi (>= 0.130)
+    # serializes the Response model straight to JSON in pydantic's Rust core.
 )
 
 # Add support for JSON-RPC invocation (https://www.jsonrpc.org/)
 from ivcap_fastapi import use_json_rpc_middleware
 use_json_rpc_middleware(app)
 
-parser = argparse.ArgumentParser(description=title)
-parser.add_argument('--host', type=str, default=os.environ.get("HOST", "localhost"), help='Host address')
-parser.add_argument('--port', type=int, default=os.environ.get("PORT", "8080"), help='Port number')
+# Pretend that processing takes this many seconds (see '--delay')
+DEFAULT_DELAY = 5
+app.state.delay = DEFAULT_DELAY
 
-parser.add_argument('--delay', type=int, default=5, help='Run in async mode, pretending that processing takes this many seconds')
+# Global alignments of similar sequences are calculated in a band around the diagonal
+AUTO_BAND = 64
+AUTO_BAND_MAX_LEN_DIFF = 32
+AUTO_BAND_KMER = 8
+AUTO_BAND_MIN_SIMILARITY = 0.5
 
-args = parser.parse_args()
-delay = args.delay
+PARASAIL_ALPHABET = "ACGT"
+INT8_MAX = 127
 
-class ModeE(StrEnum):
-    Global = "global"
-    Local = "local"
-    Fogsaa = "fogsaa"
+@lru_cache(maxsize=128)
+def _get_aligner(mode: str, match_score: float, mismatch_score: float) -> Align.PairwiseAligner:
+    """Return a (shared) aligner for the given scoring parameters.
 
-class Request(SchemaModel):
-    SCHEMA: ClassVar[str] = "urn:sd.test:schema.fastapi-test.request.1"
-    target: str = Field(description="The target sequence as a string", examples=["GAACT"])
-    query: str = Field(description="The sequence to align as a string", examples=["GAT"])
-    mode: ModeE = Field(ModeE.Local, description="Some decription on what a 'mode' means")
-    match_score: float = Field(1.000000, description="Some decription on what a 'match_score' means")
-    mismatch_score: float = Field(0.000000, description="Some decription on what a 'mismatch_score' means")
+    The returned aligner must not be modified as it is reused across requests.
+    """
+    return Align.PairwiseAligner(mode=mode, match_score=match_score, mismatch_score=mismatch_score)
 
-class Response(SchemaModel):
-    SCHEMA: ClassVar[str] = "urn:sd.test:schema.fastapi-test.response.1"
-    target: str = Field(description="The target sequence as a string", examples=["GAACT"])
-    query: str = Field(description="The sequence to align as a string", examples=["GAT"])
-    alignments: List[List[List[List[int]]]] = Field(description="a list of alignments")
-    score: float = Field(description="Overall score of the alignemnt?")
+@lru_cache(maxsize=128)
+def _get_parasail_matrix(match_score: int, mismatch_score: int):
+    return parasail.matrix_create(PARASAIL_ALPHABET, match_score, mismatch_score)
 
 def work(req: Request) -> Response:
-    p = req.model_dump(exclude=["target", "query", "aspect_schema"])
-    aligner = Align.PairwiseAligner(**p)
+    aligner = _get_aligner(req.mode.value, req.match_score, req.mismatch_score)
+    if not req.return_alignments:
+        return score_work(aligner, req)
+    if req.mode != ModeE.Local and use_kernels(aligner, req):
+        res = banded_work(aligner, req)
+        if res is not None:
+            return res
+    if req.mode != ModeE.Fogsaa and use_parasail(aligner, req):
+        res = parasail_work(aligner, req)
+        if res is not None:
+            return res
+    if req.mode == ModeE.Fogsaa and use_kernels(aligner, req):
+        return kernel_work(aligner, req)
     r = aligner.align(req.target, req.query)
-    alignments=[a.aligned.tolist() for a in r]
-    return Response(target=req.target, query=req.query, alignments=alignments, score=r.score)
+    # there can be exponentially many optimal alignments, only compute the first few
+    alignments=[a.aligned.tolist() for a in islice(r, req.max_alignments)]
+    return make_response(req, alignments, r.score)
+
+def make_response(req: Request, alignments: List[List[List[List[int]]]], score: float) -> Response:
+    """Create the response without validating it.
+
+    Validating the (potentially large) alignments we just calculated ourselves
+    costs far more than the alignment itself for short sequences.
+    """
+    return Response.model_construct(target=req.target, query=req.query, alignments=alignments,
+                                    score=float(score), aspect_schema=Response.SCHEMA)
+
+def use_parasail(aligner: Align.PairwiseAligner, req: Request) -> bool:
+    """Check if parasail can reproduce the scoring of 'aligner'.
+
+    We only use parasail for integer scores on a DNA alphabet with the same
+    affine gap penalty for insertions and deletions (including end gaps).
+    parasail also (re)opens a gap instead of extending it if that is cheaper,
+    so the extend penalty must not be larger than the open penalty.
+    """
+    if parasail is None:
+        return False
+    try:
+        scores = (aligner.match_score, aligner.mismatch_score,
+                  aligner.open_gap_score, aligner.extend_gap_score)
+    except ValueError:
+        # insertion and deletion (or end gap) scores differ
+        return False
+    if not all(s.is_integer() for s in scores) or aligner.open_gap_score > aligner.extend_gap_score or aligner.extend_gap_score > 0:
+        return False
+    return set(PARASAIL_ALPHABET).issuperset(req.target) and set(PARASAIL_ALPHABET).issuperset(req.query)
+
+def parasail_align(aligner: Align.PairwiseAligner, req: Request, traceback: bool = True):
+    """Align using parasail's SIMD kernels, returns None if the score overflowed.
+
+    8 bit scores (twice the SIMD lanes of 16 bit scores) are tried first for
+    local alignments, as their scores don't drift with sequence length, and
+    for global alignments whose scores are guaranteed to fit. If they
+    saturate, the alignment is repeated with 16 bit scores.
+
+    Tracebacks use the striped (Farrar) kernels. Score only alignments use
+    the prefix scan kernels, as the striped score only kernels report wrong
+    scores for linear gap penalties (BioPython's default).
+    """
+    match_score, mismatch_score = int(aligner.match_score), int(aligner.mismatch_score)
+    open_gap, extend_gap = int(-aligner.open_gap_score), int(-aligner.extend_gap_score)
+    matrix = _get_parasail_matrix(match_score, mismatch_score)
+    name = ("sw" if req.mode == ModeE.Local else "nw") + ("_trace_striped" if traceback else "_scan")
+    align_8, align_16 = getattr(parasail, name + "_8"), getattr(parasail, name + "_16")
+    if req.mode == ModeE.Local:
+        try_8 = True
+    else:
+        n, m = len(req.target), len(req.query)
+        worst = max(abs(match_score), abs(mismatch_score)) * min(n, m) + open_gap + extend_gap * (n + m)
+        try_8 = worst <= INT8_MAX
+    r = align_8(req.query, req.target, open_gap, extend_gap, matrix) if try_8 else None
+    if r is None or r.saturated:
+        r = align_16(req.query, req.target, open_gap, extend_gap, matrix)
+    return None if r.saturated else r
+
+def parasail_work(aligner: Align.PairwiseAligner, req: Request) -> Optional[Response]:
+    """Align using parasail's striped (Farrar) SIMD kernels.
+
+    Only a single optimal alignment is reported. Returns None if the score
+    overflowed and the caller should fall back to BioPython.
+    """
+    r = parasail_align(aligner, req)
+    if r is None:
+        return None
+    if req.mode == ModeE.Local and r.score <= 0:
+        # nothing to align (parasail doesn't report a score of 0 here)
+        return make_response(req, [], 0)
+    c = r.cigar
+    cigar = [(c.decode_len(x), c.decode_op(x).decode()) for x in c.seq]
+    alignments = [cigar_to_aligned(cigar, c.beg_ref, c.beg_query)]
+    return make_response(req, alignments, r.score)
+
+def score_work(aligner: Align.PairwiseAligner, req: Request) -> Response:
+    """Only calculate the score, skipping the (more expensive) traceback"""
+    if use_parasail(aligner, req):
+        # FOGSAA's optimal global alignment has the Needleman-Wunsch score
+        r = parasail_align(aligner, req, traceback=False)
+        if r is not None:
+            return make_response(req, [], max(r.score, 0) if req.mode == ModeE.Local else r.score)
+    if req.mode == ModeE.Fogsaa and use_kernels(aligner, req):
+        # alignments use the (exact) Gotoh kernel here, while BioPython's FOGSAA
+        # may score lower, so use the global score to match them
+        aligner = _get_aligner(ModeE.Global.value, req.match_score, req.mismatch_score)
+    return make_response(req, [], aligner.score(req.target, req.query))
+
+def use_kernels(aligner: Align.PairwiseAligner, req: Request) -> bool:
+    """Check if the numba kernels can reproduce the scoring of 'aligner'"""
+    if alignment_kernels is None:
+        return False
+    try:
+        aligner.open_gap_score, aligner.extend_gap_score
+    except ValueError:
+        # insertion and deletion (or end gap) scores differ
+        return False
+    return req._target_enc is not None
+
+def kernel_work(aligner: Align.PairwiseAligner, req: Request, band: int = -1) -> Optional[Response]:
+    """Global alignment using the (JIT compiled) Gotoh kernel. FOGSAA finds
+    an optimal global alignment as well, so this also serves 'fogsaa' mode.
+
+    Only a single optimal alignment is reported. Returns None if the
+    alignment touches the edge of 'band' (and therefore may not be optimal).
+    """
+    score, aligned, on_edge = alignment_kernels.global_align(
+        req._target_enc, req._query_enc,
+        aligner.match_score, aligner.mismatch_score,
+        aligner.open_gap_score, aligner.extend_gap_score, band)
+    if on_edge:
+        return None
+    return make_response(req, [aligned.tolist()], score)
+
+def banded_work(aligner: Align.PairwiseAligner, req: Request) -> Optional[Response]:
+    """Global alignment in a band around the diagonal, returns None if the
+    caller should use an unbanded alignment instead.
+
+    An automatically chosen band is only used if the banded alignment has
+    the optimal score. The optimal path can leave the band without the
+    banded alignment touching its edge, so this is checked against a (much
+    cheaper) score only alignment of the full sequences.
+    """
+    if req.band is not None:
+        return kernel_work(aligner, req, req.band)
+    band = auto_band(req)
+    if band is None or not use_parasail(aligner, req):
+        return None
+    res = kernel_work(aligner, req, band)
+    if res is None:
+        return None
+    # FOGSAA's optimal global alignment has the Needleman-Wunsch score
+    r = parasail_align(aligner, req, traceback=False)
+    if r is None or r.score != res.score:
+        return None
+    return res
+
+def auto_band(req: Request) -> Optional[int]:
+    """Return AUTO_BAND if the sequences look similar enough for a banded alignment"""
+    t, q = req.target, req.query
+    if min(len(t), len(q)) <= 2 * AUTO_BAND or abs(len(t) - len(q)) >= AUTO_BAND_MAX_LEN_DIFF:
+        return None
+    k = AUTO_BAND_KMER
+    t_kmers = {t[i:i + k] for i in range(len(t) - k + 1)}
+    q_kmers = {q[i:i + k] for i in range(len(q) - k + 1)}
+    similarity = len(t_kmers & q_kmers) / min(len(t_kmers), len(q_kmers))
+    return AUTO_BAND if similarity >= AUTO_BAND_MIN_SIMILARITY else None
+
+def cigar_to_aligned(cigar, target_start: int, query_start: int) -> List[List[List[int]]]:
+    """Convert a CIGAR into BioPython's 'aligned' representation"""
+    t, q = target_start, query_start
+    target_blocks, query_blocks = [], []
+    for n, op in cigar:
+        if op in "M=X":
+            if target_blocks and target_blocks[-1][1] == t and query_blocks[-1][1] == q:
+                # matches and mismatches are part of the same aligned block
+                target_blocks[-1][1] += n
+                query_blocks[-1][1] += n
+            else:
+                target_blocks.append([t, t + n])
+                query_blocks.append([q, q + n])
+            t += n
+            q += n
+        elif op == "D":
+            t += n
+        elif op == "I":
+            q += n
+    return [target_blocks, query_blocks]
 
 #####
 # Calculate alingment and return result  immedaitely
 
 @app.post("/immediate")
-def immediate(req: Request) -> Response:
-    return work(req)
+async def immediate(req: Request) -> Response:
+    return await asyncio.get_running_loop().run_in_executor(app.state.executor, work, req)
 
 @app.post("/test")
 def testf(req: dict) -> str:
@@ -106,26 +297,105 @@ def testf(req: dict) -> str:
 from ivcap_fastapi import TryLaterException, use_try_later_middleware
 use_try_later_middleware(app)
 
-jobs = {}
+# Jobs are not calculated when polled, but run in the executor while the
+# client waits. Only some of the executor's threads run delayed jobs at a time,
+# so that /immediate and /long don't queue behind a burst of delayed jobs.
+MAX_RUNNING_JOBS = max(1, (os.cpu_count() or 1) // 2)
+MAX_PENDING_JOBS = 1000 # queued or running, further jobs are rejected
+JOB_WAIT_TIMEOUT = 30 # sec, before a client polling for a job is asked to try again later
+MAX_COMPLETED_JOBS = 10_000
+COMPLETED_JOB_TTL = 3600 # sec
+
+class PendingJobs:
+    """Delayed jobs which haven't completed yet.
+
+    Jobs are started in order of submission, with at most 'max_running' of
+    them in the executor at a time. Every job runs (and completes) on its
+    own, so short jobs don't wait for longer ones started before them.
+    """
+    def __init__(self, executor: ThreadPoolExecutor, max_running: int):
+        self.executor = executor
+        self.max_running = max_running
+        self.waiting: Deque[Tuple[str, Request]] = deque()
+        self.running: Set[asyncio.Future] = set()
+
+    def __len__(self) -> int:
+        return len(self.waiting) + len(self.running)
+
+    def add(self, jobID: str, req: Request):
+        self.waiting.append((jobID, req))
+        self.start()
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        while self.waiting and len(self.running) < self.max_running:
+            jobID, req = self.waiting.popleft()
+            future = loop.run_in_executor(self.executor, work, req)
+            self.running.add(future)
+            future.add_done_callback(partial(self.finished, jobID))
+
+    def finished(self, jobID: str, future: asyncio.Future):
+        self.running.discard(future)
+        if future.cancelled():
+            # the app is shutting down
+            return
+        completed[jobID] = future.exception() or future.result()
+        app.state.job_done.pop(jobID).set()
+        self.start()
+
+    def cancel(self):
+        """Drop the waiting jobs and cancel the running ones (only stopping those the executor hasn't started)"""
+        self.waiting.clear()
+        for future in list(self.running):
+            future.cancel()
+
+completed = TTLCache(maxsize=MAX_COMPLETED_JOBS, ttl=COMPLETED_JOB_TTL) # jobID -> Response (or Exception)
+
+JOB_ID_BATCH_SIZE = 1024
+
+def job_id_generator():
+    """Yield random, URL safe job IDs (72 bits), generated in batches"""
+    while True:
+        # 9 bytes encode to 12 characters without padding
+        ids = urlsafe_b64encode(secrets.token_bytes(9 * JOB_ID_BATCH_SIZE)).decode()
+        for i in range(0, len(ids), 12):
+            yield ids[i:i + 12]
+
+# only used from the event loop, so doesn't need to be thread safe
+job_ids = job_id_generator()
 
 @app.post("/delayed")
-def delayed(req: Request) -> Response:
-    jobID = ''.join(random.choice(string.ascii_letters) for i in range(10))
-    jobs[jobID] = req
-    raise TryLaterException(f"/jobs/{jobID}", delay)
+async def delayed(req: Request) -> Response:
+    if len(app.state.pending) >= MAX_PENDING_JOBS:
+        raise HTTPException(status_code=503, detail="Too many pending jobs, try again later",
+                            headers={"Retry-After": f"{app.state.delay}"})
+    jobID = next(job_ids)
+    app.state.job_done[jobID] = asyncio.Event()
+    app.state.pending.add(jobID, req)
+    raise TryLaterException(f"/jobs/{jobID}", app.state.delay)
 
 @app.get("/jobs/{jobID}")
-def get_job(jobID: str) -> Response:
-    req = jobs[jobID]
-    return work(req)
+async def get_job(jobID: str) -> Response:
+    done = app.state.job_done.get(jobID)
+    if done is not None:
+        try:
+            await asyncio.wait_for(done.wait(), JOB_WAIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise TryLaterException(f"/jobs/{jobID}", app.state.delay)
+    res = completed.pop(jobID, None)
+    if res is None:
+        raise HTTPException(status_code=404, detail=f"Unknown or expired job '{jobID}'")
+    if isinstance(res, Exception):
+        raise res
+    return res
 
 #####
 # Simulate a long running calculation.
 
 @app.post("/long")
-def immediate(req: Request) -> Response:
-    sleep(delay)
-    return work(req)
+async def immediate(req: Request) -> Response:
+    await asyncio.sleep(app.state.delay)
+    return await asyncio.get_running_loop().run_in_executor(app.state.executor, work, req)
 
 
 # Allows platform to check if everything is OK
@@ -135,6 +405,18 @@ def healtz():
 
 if __name__ == "__main__":
     import uvicorn
+
+    parser = argparse.ArgumentParser(description=title)
+    parser.add_argument('--host', type=str, default=os.environ.get("HOST", "localhost"), help='Host address')
+    parser.add_argument('--port', type=int, default=os.environ.get("PORT", "8080"), help='Port number')
+
+    parser.add_argument('--delay', type=int, default=DEFAULT_DELAY, help='Run in async mode, pretending that processing takes this many seconds')
+
+    args = parser.parse_args()
+    app.state.delay = args.delay
+
+    # shutdown pod cracefully
+    signal(SIGTERM, lambda _1, _2: sys.exit(0))
     print(f"INFO:     {title} - {os.getenv('VERSION')}")
-    if delay > 0: print(f"INFO:     Operating with artifical delay of {delay} sec")
+    if args.delay > 0: print(f"INFO:     Operating with artifical delay of {args.delay} sec")
     uvicorn.run(app, host=args.host, port=args.port)
\ No newline at end of file
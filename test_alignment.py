@@ -0,0 +1,169 @@
+import random
+
+import pytest
+from Bio import Align
+
+import service
+from schema import Request
+
+# BioPython's default gap scores
+OPEN_GAP, EXTEND_GAP = -1.0, -1.0
+INT16_MAX = 32767
+
+def random_seq(rnd: random.Random, n: int) -> str:
+    return "".join(rnd.choice("ACGT") for _ in range(n))
+
+def random_requests(mode: str, count: int = 200, max_len: int = 80):
+    rnd = random.Random(42)
+    for _ in range(count):
+        yield Request(target=random_seq(rnd, rnd.randint(1, max_len)),
+                      query=random_seq(rnd, rnd.randint(1, max_len)),
+                      mode=mode,
+                      match_score=rnd.choice([1.0, 2.0, 3.0]),
+                      mismatch_score=rnd.choice([0.0, -1.0, -2.0]))
+
+def rotated_requests(count: int = 50):
+    """Similar length sequences whose optimal alignment lies far off the diagonal"""
+    rnd = random.Random(7)
+    for _ in range(count):
+        x, y = random_seq(rnd, rnd.randint(70, 150)), random_seq(rnd, rnd.randint(100, 300))
+        yield Request(target=x + y, query=y + x[:-rnd.randint(1, 20)], mode="global")
+
+def expected_score(req: Request) -> float:
+    aligner = Align.PairwiseAligner(mode=req.mode.value, match_score=req.match_score, mismatch_score=req.mismatch_score)
+    return aligner.score(req.target, req.query)
+
+def rescore(req: Request, aligned) -> float:
+    """Check that 'aligned' is a valid alignment of the request's sequences and return its score"""
+    t, q = req.target, req.query
+    target_blocks, query_blocks = aligned
+    assert len(target_blocks) == len(query_blocks)
+    gap = lambda n: OPEN_GAP + (n - 1) * EXTEND_GAP if n > 0 else 0
+    score = 0.0
+    t_end, q_end = None, None
+    for (t_start, t_stop), (q_start, q_stop) in zip(target_blocks, query_blocks):
+        assert 0 <= t_start < t_stop <= len(t) and 0 <= q_start < q_stop <= len(q)
+        assert t_stop - t_start == q_stop - q_start
+        if t_end is not None:
+            assert t_start >= t_end and q_start >= q_end
+            score += gap(t_start - t_end) + gap(q_start - q_end)
+        score += sum(req.match_score if a == b else req.mismatch_score
+                     for a, b in zip(t[t_start:t_stop], q[q_start:q_stop]))
+        t_end, q_end = t_stop, q_stop
+    if req.mode != "local":
+        if target_blocks:
+            score += gap(target_blocks[0][0]) + gap(query_blocks[0][0])
+            score += gap(len(t) - t_end) + gap(len(q) - q_end)
+        else:
+            score += gap(len(t)) + gap(len(q))
+    return score
+
+def check(req: Request, res):
+    assert res is not None
+    assert res.score == expected_score(req)
+    assert len(res.alignments) <= 1
+    for aligned in res.alignments:
+        assert rescore(req, aligned) == res.score
+
+def aligner_for(req: Request) -> Align.PairwiseAligner:
+    return service._get_aligner(req.mode.value, req.match_score, req.mismatch_score)
+
+needs_parasail = pytest.mark.skipif(service.parasail is None, reason="parasail not installed")
+needs_kernels = pytest.mark.skipif(service.alignment_kernels is None, reason="numba not installed")
+
+@needs_parasail
+@pytest.mark.parametrize("mode", ["local", "global"])
+def test_parasail(mode):
+    for req in random_requests(mode):
+        check(req, service.parasail_work(aligner_for(req), req))
+
+@needs_parasail
+@pytest.mark.parametrize("mode", ["local", "global"])
+@pytest.mark.parametrize("length, match_score", [(40, 1.0), (600, 1.0), (400, 100.0)])
+def test_saturation(mode, length, match_score):
+    # scores fitting 8 bits, needing 16 bits, and overflowing 16 bits (BioPython is used)
+    rnd = random.Random(5)
+    t = random_seq(rnd, length)
+    q = t[:length // 3] + random_seq(rnd, 3) + t[length // 3 + 5:]
+    req = Request(target=t, query=q, mode=mode, match_score=match_score, mismatch_score=-1.0)
+    res = service.parasail_work(aligner_for(req), req)
+    if expected_score(req) > INT16_MAX:
+        assert res is None
+    else:
+        check(req, res)
+    res = service.work(req)
+    assert res.score == expected_score(req)
+    for aligned in res.alignments:
+        assert rescore(req, aligned) == res.score
+
+@needs_kernels
+@pytest.mark.parametrize("mode", ["global", "fogsaa"])
+def test_kernel(mode):
+    for req in random_requests(mode):
+        check(req, service.kernel_work(aligner_for(req), req))
+
+@needs_kernels
+def test_kernel_non_dna():
+    rnd = random.Random(3)
+    for _ in range(100):
+        req = Request(target="".join(rnd.choice("ACDEFGHIKLMNPQRSTVWY") for _ in range(rnd.randint(1, 60))),
+                      query="".join(rnd.choice("ACDEFGHIKLMNPQRSTVWY") for _ in range(rnd.randint(1, 60))),
+                      mode="fogsaa", match_score=2.5, mismatch_score=-0.5)
+        check(req, service.kernel_work(aligner_for(req), req))
+
+@needs_kernels
+def test_banded():
+    # an explicit band must either find an optimal alignment or give up
+    for req in random_requests("global", max_len=300):
+        req.band = 8
+        res = service.kernel_work(aligner_for(req), req, req.band)
+        if res is not None:
+            for aligned in res.alignments:
+                assert rescore(req, aligned) == res.score
+            assert res.score <= expected_score(req)
+
+@needs_kernels
+@needs_parasail
+def test_auto_band():
+    # the optimal alignment of these lies outside the band
+    for req in rotated_requests():
+        res = service.banded_work(aligner_for(req), req)
+        if res is not None:
+            check(req, res)
+        check(req, service.work(req))
+    # similar sequences are aligned in a band
+    rnd = random.Random(11)
+    t = random_seq(rnd, 1000)
+    q = t[:300] + t[310:700] + random_seq(rnd, 5) + t[700:]
+    req = Request(target=t, query=q, mode="global")
+    check(req, service.banded_work(aligner_for(req), req))
+
+@pytest.mark.parametrize("mode", ["local", "global", "fogsaa"])
+def test_score_only(mode):
+    for req in random_requests(mode):
+        req.return_alignments = False
+        res = service.work(req)
+        assert res.alignments == []
+        assert res.score == expected_score(req)
+
+@needs_kernels
+def test_score_only_fogsaa():
+    # BioPython's FOGSAA misses the optimal alignment of these
+    req = Request(target="KLMNP" * 30, query="KLN" * 30, mode="fogsaa", match_score=-1.0, mismatch_score=2.0)
+    res = service.work(req)
+    assert res.score == 120.0
+    req.return_alignments = False
+    assert service.work(req).score == res.score
+
+@pytest.mark.parametrize("mode", ["local", "global", "fogsaa"])
+def test_work(mode):
+    for req in random_requests(mode, count=100):
+        res = service.work(req)
+        assert res.score == expected_score(req)
+        for aligned in res.alignments:
+            assert rescore(req, aligned) == res.score
+
+def test_cigar_to_aligned():
+    cigar = [(2, "="), (1, "X"), (3, "D"), (1, "="), (2, "I"), (4, "M")]
+    assert service.cigar_to_aligned(cigar, 5, 1) == [[[5, 8], [11, 12], [12, 16]],
+                                                     [[1, 4], [4, 5], [7, 11]]]
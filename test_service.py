@@ -0,0 +1,27 @@
+from fastapi.testclient import TestClient
+
+import service
+
+REQUEST = {"target": "GAACT", "query": "GAT", "mode": "global"}
+
+def test_restart():
+    service.app.state.delay = 0
+    # every start of the app needs its own executor and job queue
+    for _ in range(2):
+        with TestClient(service.app) as client:
+            r = client.post("/immediate", json=REQUEST)
+            assert r.status_code == 200
+            assert r.json()["score"] == 1.0
+            r = client.post("/delayed", json=REQUEST, follow_redirects=False)
+            assert r.status_code == 204
+            r = client.get(r.headers["location"])
+            assert r.status_code == 200
+            assert r.json()["score"] == 1.0
+
+def test_empty_sequence():
+    with TestClient(service.app) as client:
+        for mode in ("local", "global", "fogsaa"):
+            r = client.post("/immediate", json={"target": "", "query": "GAT", "mode": mode})
+            assert r.status_code == 422
+            r = client.post("/immediate", json={"target": "GAT", "query": "", "mode": mode})
+            assert r.status_code == 422
@@ -1,4 +1,6 @@
+from copy import deepcopy
 from enum import Enum
+from functools import cache
 from typing import ClassVar, List, TypeVar, Type as TypeT
 from pydantic import BaseModel, Field, TypeAdapter, field_serializer, model_validator
 
@@ -11,6 +13,12 @@ class SchemaModel(BaseModel):
 
     @classmethod
     def json_schema(cls, *, json_schema="https://json-schema.org/draft/2020-12/schema"):
+        # copy, as the caller may modify it
+        return deepcopy(cls._json_schema(json_schema))
+
+    @classmethod
+    @cache
+    def _json_schema(cls, json_schema: str) -> dict:
         if not hasattr(cls, 'SCHEMA'):
             raise Exception("Missing 'SCHEMA' declaration")
         s = {
@@ -19,11 +27,16 @@ class SchemaModel(BaseModel):
         }
         if hasattr(cls, 'DESCRIPTION'):
             s["description"] = cls.DESCRIPTION
-        t = TypeAdapter(cls)
-        s.update(t.json_schema())
+        s.update(cls._type_adapter().json_schema())
         s["properties"].pop("$schema")
         return s
 
+    @classmethod
+    @cache
+    def _type_adapter(cls) -> TypeAdapter:
+        # building the adapter compiles a core schema, so only do it once per class
+        return TypeAdapter(cls)
+
     @model_validator(mode='after')
     def set_aspect_schema(self) -> "SchemaModel":
         if not hasattr(self.__class__, 'SCHEMA'):